@@ -0,0 +1,284 @@
+# Class to handle talking to TrueNAS through its REST API, for
+# resources that are easier to drive over HTTP than through 'midclt'
+# (e.g., /virt/instance on TrueNAS SCALE 25.04 and later).
+#
+# The docs for the REST API itself are at
+# https://<your-NAS>/api/docs/, under "API v2.0".
+
+__metaclass__ = type
+"""
+This module adds a small client for the TrueNAS REST API.
+"""
+
+import json
+import time
+
+# orjson's C parser is a few times faster than the stdlib on typical
+# API payloads, and serializes straight to bytes. It's optional,
+# though: fall back to the stdlib if it isn't on the host.
+try:
+    import orjson
+
+    def _dumps(obj):
+        return orjson.dumps(obj)
+
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+    _loads = json.loads
+
+# urllib3 gives us a connection pool, so that every request in a
+# module run reuses one TCP+TLS session, instead of paying a fresh
+# DNS lookup and TLS handshake per call. It might not be installed on
+# the remote host, though, so if it isn't, fall back to running
+# 'curl'.
+#
+# Why not ansible.module_utils.urls.fetch_url, which ships with
+# Ansible? Because it builds a fresh urllib opener (and hence a fresh
+# TLS session) for every single call, which is the exact overhead
+# we're trying to avoid in poll loops. If you don't have urllib3, the
+# curl fallback below is no worse than fetch_url would be.
+try:
+    import urllib3
+    # We talk to the NAS itself, usually with a self-signed cert, so
+    # don't spam the user with InsecureRequestWarning.
+    urllib3.disable_warnings()
+    HAS_URLLIB3 = True
+except ImportError:
+    HAS_URLLIB3 = False
+
+
+# Marker for "json() hasn't been called yet", since None is a
+# perfectly good parse result ("null").
+_UNSET = object()
+
+# Marker for "the body was there, but wasn't valid JSON". Callers
+# should treat this as an error, not as a missing resource: a
+# middleware error page that quietly parses as "nothing here" leads
+# them to issue doomed follow-up calls.
+JSON_ERROR = object()
+
+
+class ApiResponse:
+    """One response from the TrueNAS REST API."""
+
+    # One of these is allocated per API call, including every poll in
+    # a wait loop, so skip the per-instance __dict__.
+    __slots__ = ('status_code', 'text', 'stderr', '_parsed')
+
+    def __init__(self, status_code, body, stderr=''):
+        # The real HTTP status code, as an int.
+        self.status_code = status_code
+        # The response body, as a string.
+        self.text = body
+        # Anything the transport printed on stderr (only the curl
+        # fallback sets this).
+        self.stderr = stderr
+        # The parsed body, filled in by the first json() call.
+        self._parsed = _UNSET
+
+    def json(self):
+        """Return the response body, parsed as JSON.
+
+        An empty body returns {}; a non-empty body that doesn't parse
+        returns the JSON_ERROR marker, so callers can tell "nothing
+        there" from "the server sent us garbage". The result is
+        cached, so callers can call json() as often as they like and
+        only pay for one parse.
+        """
+        if self._parsed is _UNSET:
+            if self.text is None or self.text.strip() == '':
+                self._parsed = {}
+            else:
+                try:
+                    self._parsed = _loads(self.text)
+                except (ValueError, TypeError):
+                    self._parsed = JSON_ERROR
+        return self._parsed
+
+
+class RestApiClient:
+    """Client for the TrueNAS REST API (/api/v2.0).
+
+    Uses a single keep-alive HTTP(S) session for every call made
+    through one client, so that a module that makes several API calls
+    (or polls for a state change) only pays for one TLS handshake.
+    """
+
+    __slots__ = ('module', 'api_url', '_base', 'api_key', 'headers',
+                 '_header_args', '_get_cache', 'cache_ttl',
+                 '_instances', 'http')
+
+    def __init__(self, module, api_url, api_key, cache_ttl=1.0):
+        self.module = module
+        self.api_url = api_url or 'https://localhost/api/v2.0'
+        # The API root with any trailing slash already stripped, so
+        # call() doesn't redo that on every request.
+        self._base = self.api_url.rstrip('/')
+        self.api_key = api_key
+        self.headers = {
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json',
+            # Instance lists compress very well; urllib3 decodes
+            # transparently, and the curl path passes --compressed.
+            'Accept-Encoding': 'gzip',
+        }
+        # The headers again, pre-rendered as curl arguments, so the
+        # fallback path doesn't re-format them on every call.
+        self._header_args = []
+        for key, value in self.headers.items():
+            self._header_args.extend(['-H', f'{key}: {value}'])
+
+        # Cache of recent GET responses, as url -> (timestamp,
+        # ApiResponse). A module run tends to ask for the same
+        # resource several times in quick succession (e.g., a poll
+        # loop), and within 'cache_ttl' seconds we just hand back the
+        # response we already have.
+        self._get_cache = {}
+        self.cache_ttl = cache_ttl
+
+        # Cache for list_instances(): name -> instance info dict.
+        self._instances = None
+
+        if HAS_URLLIB3:
+            # One pool for one host: every call() reuses the same
+            # keep-alive connections.
+            self.http = urllib3.PoolManager(
+                num_pools=1,
+                maxsize=4,
+                cert_reqs='CERT_NONE',
+                retries=urllib3.Retry(total=2, backoff_factor=0.1))
+        else:
+            self.http = None
+
+    def call(self, url, method='GET', data=None, timeout=30,
+             use_cache=True):
+        """Call the API endpoint 'url' with HTTP method 'method'.
+
+        'url' may be a path relative to the API root, like
+        "/virt/instance", or a full URL.
+
+        'data', if given, is sent as the JSON request body.
+
+        'use_cache=False' skips the GET cache and always asks the
+        server. Poll loops need this: serving a sub-second re-poll
+        from the cache would just hand back the same stale snapshot,
+        defeating the point of polling quickly.
+
+        Returns an ApiResponse.
+        """
+
+        if url.startswith('http'):
+            pass
+        elif url.startswith('/'):
+            url = self._base + url
+        else:
+            url = self._base + '/' + url
+
+        # For GETs, see whether we already have a fresh enough answer.
+        if method == 'GET' and use_cache:
+            cached = self._get_cache.get(url)
+            if cached is not None and \
+               time.time() - cached[0] < self.cache_ttl:
+                return cached[1]
+
+        body = None
+        if data is not None:
+            body = _dumps(data)
+
+        if self.http is not None:
+            response = self._call_urllib3(url, method, body, timeout)
+        else:
+            response = self._call_curl(url, method, body, timeout)
+
+        if method == 'GET':
+            self._get_cache[url] = (time.time(), response)
+        else:
+            # Anything other than a GET may have changed state on the
+            # server, so whatever we cached is now suspect.
+            self._get_cache.clear()
+            self._instances = None
+
+        return response
+
+    def list_instances(self, force=False):
+        """Return every virt instance, as a dict of name -> info dict.
+
+        The list is fetched once and then cached for the life of this
+        client; any write made through call() invalidates it. That
+        way a caller that looks up several instances by name pays for
+        one list fetch, total.
+        """
+
+        if force or self._instances is None:
+            response = self.call('/virt/instance', method='GET')
+            if response.status_code != 200:
+                # Fail loudly, rather than returning {}: an empty
+                # dict here reads as "no instances", and the caller
+                # would go on to make decisions (deletes, doomed
+                # creates) based on a middleware error.
+                self.module.fail_json(msg=f"Error listing instances: {response.status_code} {response.text}")
+            instances = response.json()
+            if instances is JSON_ERROR or not isinstance(instances, list):
+                self.module.fail_json(msg=f"Error listing instances: can't parse API response: {response.text}")
+            self._instances = {inst.get('name'): inst
+                               for inst in instances}
+        return self._instances
+
+    def _call_urllib3(self, url, method, body, timeout):
+        """Make one request on the keep-alive pool."""
+
+        try:
+            resp = self.http.request(
+                method, url,
+                body=body,
+                headers=self.headers,
+                timeout=urllib3.Timeout(connect=timeout, read=timeout))
+        except urllib3.exceptions.HTTPError as e:
+            self.module.fail_json(msg=f"Error calling TrueNAS API {url}: {e}")
+
+        # urllib3 hands us the real HTTP status, so just pass it
+        # through.
+        return ApiResponse(resp.status, resp.data.decode('utf-8'))
+
+    def _call_curl(self, url, method, body, timeout):
+        """Fallback path: fork a 'curl' process for this one request.
+
+        Slower than the pool (a fresh TCP+TLS handshake per call),
+        but only needs the curl binary on the host.
+        """
+
+        cmd = ['curl', '-s', '-k',
+               '--no-buffer', '--tcp-nodelay',
+               '--compressed',
+               '--keepalive-time', '60',
+               '-X', method,
+               '--max-time', str(timeout),
+               # Have curl print the real HTTP status on a line of
+               # its own after the body, so we don't have to guess
+               # from the exit code.
+               '-w', '\n%{http_code}']
+        cmd.extend(self._header_args)
+        if body is not None:
+            # Feed the body through stdin, rather than putting it on
+            # the command line: argv space is limited (ARG_MAX), and
+            # a big 'devices' dict could conceivably blow it.
+            cmd.extend(['-d', '@-'])
+        cmd.append(url)
+
+        rc, stdout, stderr = self.module.run_command(cmd, data=body,
+                                                     binary_data=True,
+                                                     check_rc=False)
+
+        # Split the status code back off the tail of the output.
+        response_body, _, code = stdout.rpartition('\n')
+        try:
+            status = int(code)
+        except ValueError:
+            # curl died before it could print a status (network
+            # error, timeout, ...).
+            status = 0
+
+        return ApiResponse(status, response_body, stderr)
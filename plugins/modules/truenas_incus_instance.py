@@ -0,0 +1,590 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+__metaclass__ = type
+
+# Manage Incus virtualization instances (containers and VMs) on
+# TrueNAS SCALE 25.04 and later, through the /virt/instance REST
+# endpoint.
+#
+# Unlike most modules in this collection, this one talks to the REST
+# API rather than 'midclt', because the virt endpoints are only
+# usefully exposed there on current SCALE releases.
+
+DOCUMENTATION = r'''
+---
+module: truenas_incus_instance
+short_description: Manage Incus instances (containers and VMs)
+description:
+  - Create, delete, start, stop, and restart Incus virtualization
+    instances on TrueNAS SCALE, using the C(/virt/instance) REST
+    endpoint.
+  - Requires TrueNAS SCALE 25.04 (Fangtooth) or later, with
+    virtualization configured.
+options:
+  name:
+    description:
+      - Name of the instance.
+    type: str
+    required: true
+  state:
+    description:
+      - Desired state of the instance.
+      - "C(present): make sure the instance exists."
+      - "C(absent): make sure the instance does not exist."
+      - "C(started)/C(stopped): make sure the instance exists and is
+        running/not running."
+      - C(restarted) will unconditionally restart the instance.
+    type: str
+    choices: [ absent, present, restarted, started, stopped ]
+    default: present
+  type:
+    description:
+      - Type of instance to create.
+    type: str
+    choices: [ CONTAINER, VM ]
+    default: CONTAINER
+  source:
+    description:
+      - Image to create the instance from, e.g. C(debian/bookworm).
+      - Only used at creation time.
+    type: str
+  config:
+    description:
+      - Instance configuration options, as a dict of Incus
+        configuration keys.
+      - Supported keys are C(limits.cpu), C(limits.memory) (in
+        bytes), and C(boot.autostart). Other keys are an error.
+    type: dict
+  devices:
+    description:
+      - Devices to attach to the instance, as a dict mapping device
+        names to device definitions.
+    type: dict
+  timeout:
+    description:
+      - Time, in seconds, to wait for the instance to reach the
+        desired state.
+    type: int
+    default: 60
+  api_url:
+    description:
+      - Base URL of the TrueNAS REST API.
+    type: str
+    default: https://localhost/api/v2.0
+  api_key:
+    description:
+      - TrueNAS API key to authenticate with.
+    type: str
+    required: true
+version_added: 1.14.0
+'''
+
+EXAMPLES = '''
+- name: Create and start a container
+  hosts: my-truenas-server
+  tasks:
+    - arensb.truenas.truenas_incus_instance:
+        name: my-container
+        state: started
+        source: debian/bookworm
+        config:
+          boot.autostart: "true"
+        api_key: "{{ truenas_api_key }}"
+
+- name: Make sure an old VM is gone
+  hosts: my-truenas-server
+  tasks:
+    - arensb.truenas.truenas_incus_instance:
+        name: old-vm
+        state: absent
+        api_key: "{{ truenas_api_key }}"
+'''
+
+RETURN = '''
+instance:
+  description: Information about the instance, as returned by the API.
+  type: dict
+  returned: always, if the instance exists
+'''
+
+import time
+from urllib.parse import quote
+
+from ansible.module_utils.basic import AnsibleModule
+try:
+    from ..module_utils.rest_api import RestApiClient, JSON_ERROR
+except ImportError:
+    # Not running under Ansible's module loader (e.g., unit tests
+    # importing this file directly): expect rest_api to be findable
+    # on sys.path.
+    from rest_api import RestApiClient, JSON_ERROR
+
+
+# Status codes that mean the API accepted a write.
+_OK_CREATED = frozenset((200, 201))
+# ... and what a successful delete can return.
+_OK_DELETED = frozenset((200, 204))
+
+# Values accepted as boolean true in Incus config values, which are
+# all strings on the Incus side.
+_TRUE_VALUES = frozenset((True, 'true', 'yes', 'on', '1'))
+
+# The Incus config keys we support, and the /virt/instance schema
+# fields they map to. Note that 'environment' in that schema is the
+# container's environment variables, not configuration, so a key we
+# can't map is an error, not something to smuggle in there.
+_CONFIG_FIELD_MAP = {
+    'boot.autostart': 'autostart',
+    'limits.cpu': 'cpu',
+    'limits.memory': 'memory',
+}
+
+
+# Passed as 'desired_state' to the wait helpers to mean "the
+# instance no longer exists", which isn't a status string the API
+# could ever report.
+_ABSENT = object()
+
+
+def _state_ok(instance, desired_state):
+    """Is 'instance' (possibly None) in 'desired_state'?
+
+    'desired_state' may be a status string like 'Running', None for
+    "exists, whatever its status", or _ABSENT for "doesn't exist".
+    """
+
+    if desired_state is _ABSENT:
+        return instance is None
+    if instance is None:
+        return False
+    return desired_state is None or \
+        instance.get('status') == desired_state
+
+
+def _map_config(module, config):
+    """Translate the 'config' parameter to /virt/instance schema fields.
+
+    Returns a dict of API field -> value, with values coerced to the
+    types the schema wants. Unsupported keys are a hard error: better
+    to fail now than to send the API something it will silently
+    ignore (or worse, misinterpret).
+    """
+
+    fields = {}
+    for key, value in (config or {}).items():
+        api_field = _CONFIG_FIELD_MAP.get(key)
+        if api_field is None:
+            module.fail_json(msg=f"Unsupported config key {key}. Supported keys: {', '.join(sorted(_CONFIG_FIELD_MAP))}.")
+        if api_field == 'autostart':
+            value = value in _TRUE_VALUES
+        elif api_field == 'memory':
+            # The API wants a number of bytes.
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                module.fail_json(msg=f"limits.memory must be a number of bytes, not {value!r}")
+        fields[api_field] = value
+    return fields
+
+
+def get_instance(module, api_client, name, use_cache=True):
+    """Look up the instance called 'name'.
+
+    Returns the instance info dict, or None if there is no such
+    instance.
+
+    An instance's API id is its name, so we can ask the server for
+    just the one record, instead of fetching the whole instance list
+    and searching it ourselves. Pass 'use_cache=False' when a stale
+    answer won't do, e.g. from a poll loop.
+    """
+
+    response = api_client.call(f'/virt/instance/id/{quote(name, safe="")}',
+                               method='GET', use_cache=use_cache)
+    if response.status_code == 404:
+        # No such instance.
+        return None
+    if response.status_code != 200:
+        # A middleware error is not the same thing as "no such
+        # instance": if we pretended it were, the caller would go on
+        # to issue a doomed create call.
+        module.fail_json(msg=f"Error looking up instance {name}: {response.status_code} {response.text}")
+
+    instance = response.json()
+    if instance is JSON_ERROR:
+        module.fail_json(msg=f"Error looking up instance {name}: can't parse API response: {response.text}")
+
+    return instance or None
+
+
+def create_instance(module, api_client):
+    """Create a new instance from the module parameters.
+
+    Returns the API response. Like the other write endpoints, the
+    create POST answers with a middleware job id; the caller should
+    run it through _wait_for_transition() before touching the
+    instance.
+    """
+
+    p = module.params
+    payload = {
+        'name': p['name'],
+        'instance_type': p['type'],
+    }
+    # Optional parameters, and what the API calls them.
+    payload.update({api_field: p[param]
+                    for param, api_field in (('source', 'image'),
+                                             ('devices', 'devices'))
+                    if p.get(param)})
+
+    # The config dict holds Incus config keys; translate them to the
+    # schema fields the API actually understands. This also folds
+    # boot.autostart into the create call itself, rather than making
+    # a separate start call afterward.
+    payload.update(_map_config(module, p['config']))
+
+    response = api_client.call('/virt/instance', method='POST',
+                               data=payload)
+    if response.status_code not in _OK_CREATED:
+        module.fail_json(msg=f"Error creating instance {p['name']}: {response.text}")
+    return response
+
+
+def start_instance(module, api_client, instance_id):
+    """Start the instance 'instance_id'."""
+
+    response = api_client.call(f'/virt/instance/{instance_id}/start',
+                               method='POST')
+    if response.status_code not in _OK_CREATED:
+        module.fail_json(msg=f"Error starting instance {instance_id}: {response.text}")
+    return response
+
+
+def stop_instance(module, api_client, instance_id):
+    """Stop the instance 'instance_id'."""
+
+    response = api_client.call(f'/virt/instance/{instance_id}/stop',
+                               method='POST')
+    if response.status_code not in _OK_CREATED:
+        module.fail_json(msg=f"Error stopping instance {instance_id}: {response.text}")
+    return response
+
+
+def restart_instance(module, api_client, instance_id):
+    """Restart the instance 'instance_id'."""
+
+    response = api_client.call(f'/virt/instance/{instance_id}/restart',
+                               method='POST')
+    if response.status_code not in _OK_CREATED:
+        module.fail_json(msg=f"Error restarting instance {instance_id}: {response.text}")
+    return response
+
+
+def delete_instance(module, api_client, instance):
+    """Delete the instance described by the info dict 'instance'.
+
+    The instance has to be stopped before it can be deleted, so stop
+    it first if it's running. We take the instance dict, rather than
+    just an ID, so we can check the status we've already fetched
+    instead of asking the API again.
+
+    Returns the DELETE response; it carries a middleware job id, so
+    the caller should wait on it (desired state _ABSENT) before
+    claiming the instance is gone.
+    """
+
+    instance_id = instance['id']
+
+    if instance.get('status') == 'Running':
+        stop_instance(module, api_client, instance_id)
+
+    response = api_client.call(f'/virt/instance/{instance_id}',
+                               method='DELETE')
+    if response.status_code not in _OK_DELETED:
+        module.fail_json(msg=f"Error deleting instance {instance_id}: {response.text}")
+    return response
+
+
+def _instance_matches(instance, fields, devices):
+    """Does the existing 'instance' already look the way the caller asked?
+
+    'fields' is the caller's config, already run through
+    _map_config(), so compare against the instance record's own
+    schema fields -- not its 'environment', which holds environment
+    variables. Shallow subset check: every field and device the
+    caller specified has to be present, with the same value, in what
+    the API reported. Anything the caller didn't mention is ignored.
+    """
+
+    for api_field, value in (fields or {}).items():
+        if instance.get(api_field) != value:
+            return False
+
+    have_devices = instance.get('devices') or {}
+    for dev_name, dev in (devices or {}).items():
+        if have_devices.get(dev_name) != dev:
+            return False
+
+    return True
+
+
+def wait_for_state(module, api_client, name, desired_state, timeout):
+    """Wait until instance 'name' is in state 'desired_state'.
+
+    Polls the API until the instance reports the desired state (see
+    _state_ok() for the values 'desired_state' can take), or
+    'timeout' seconds have passed. Returns True if the state was
+    reached, False if we timed out.
+
+    The first poll happens immediately, and the delay between polls
+    backs off from 0.1s up to 2s: fast transitions get noticed right
+    away, while slow ones don't hammer the API any harder than the
+    old fixed 2-second poll did.
+    """
+
+    deadline = time.time() + timeout
+    delay = 0.1
+    while True:
+        # Skip the client's GET cache: re-reading a cached snapshot
+        # would make every sub-second poll a no-op.
+        instance = get_instance(module, api_client, name,
+                                use_cache=False)
+        if _state_ok(instance, desired_state):
+            return True
+
+        now = time.time()
+        if now >= deadline:
+            return False
+        time.sleep(min(delay, deadline - now))
+        delay = min(delay * 1.7, 2.0)
+
+
+def _wait_for_job(module, api_client, job_id, timeout):
+    """Wait for middleware job 'job_id' to finish.
+
+    Job records are small and carry an explicit SUCCESS/FAILED state,
+    so polling one is much cheaper than re-fetching instance state.
+    Returns True if the job succeeded, False if it failed or we timed
+    out.
+    """
+
+    deadline = time.time() + timeout
+    delay = 0.05
+    while True:
+        # use_cache=False for the same reason as wait_for_state: a
+        # 50ms poll interval is pointless if every poll inside the
+        # cache TTL returns the first job snapshot.
+        response = api_client.call(f'/core/get_jobs?id={job_id}',
+                                   method='GET', use_cache=False)
+        jobs = response.json()
+        if isinstance(jobs, list) and jobs:
+            job_state = jobs[0].get('state')
+            if job_state == 'SUCCESS':
+                return True
+            if job_state in ('FAILED', 'ABORTED'):
+                return False
+
+        now = time.time()
+        if now >= deadline:
+            return False
+        time.sleep(min(delay, deadline - now))
+        delay = min(delay * 1.7, 2.0)
+
+
+def _wait_for_transition(module, api_client, response, name,
+                         desired_state, timeout):
+    """Wait for a write to the instance to take effect.
+
+    The virt endpoints answer their write calls (create, delete,
+    start, stop, restart) with a middleware job id: when we get one,
+    wait on the job and then confirm the instance state once. If no
+    job id came back, fall back to polling the instance state.
+    'desired_state' takes the same values as _state_ok().
+    """
+
+    job_id = response.json() if response is not None else None
+    if isinstance(job_id, int):
+        if not _wait_for_job(module, api_client, job_id, timeout):
+            return False
+        # The job just finished; confirm with a fresh read, not a
+        # possibly pre-transition cached one.
+        instance = get_instance(module, api_client, name,
+                                use_cache=False)
+        return _state_ok(instance, desired_state)
+
+    return wait_for_state(module, api_client, name, desired_state,
+                          timeout)
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            name=dict(type='str', required=True),
+            state=dict(type='str', default='present',
+                       choices=['absent', 'present', 'restarted',
+                                'started', 'stopped']),
+            type=dict(type='str', default='CONTAINER',
+                      choices=['CONTAINER', 'VM']),
+            source=dict(type='str'),
+            config=dict(type='dict'),
+            devices=dict(type='dict'),
+            timeout=dict(type='int', default=60),
+            api_url=dict(type='str',
+                         default='https://localhost/api/v2.0'),
+            api_key=dict(type='str', required=True, no_log=True),
+        ),
+        supports_check_mode=True,
+    )
+
+    result = dict(
+        changed=False,
+        msg=''
+    )
+
+    # Assign variables from properties, for convenience
+    name = module.params['name']
+    state = module.params['state']
+    timeout = module.params['timeout']
+
+    api_client = RestApiClient(module,
+                               module.params['api_url'],
+                               module.params['api_key'])
+
+    # Look up the instance. Go through the client's cached instance
+    # list, so that several lookups in one client's lifetime share a
+    # single fetch.
+    instance = api_client.list_instances().get(name)
+    result['instance'] = instance
+
+    if state == 'absent':
+        # Instance is not supposed to exist.
+        if instance is None:
+            # All is well.
+            result['changed'] = False
+        else:
+            if module.check_mode:
+                result['msg'] = f"Would have deleted instance {name}"
+            else:
+                response = delete_instance(module, api_client, instance)
+                # Don't report changed until the delete job has
+                # actually run and the instance is gone.
+                if not _wait_for_transition(module, api_client,
+                                            response, name, _ABSENT,
+                                            timeout):
+                    module.fail_json(msg=f"Timed out waiting for instance {name} to be deleted")
+            result['changed'] = True
+
+    elif state == 'present':
+        # Instance is supposed to exist. Don't care whether it's
+        # running.
+        if instance is None:
+            if module.check_mode:
+                result['msg'] = f"Would have created instance {name}"
+            else:
+                response = create_instance(module, api_client)
+                # The create POST answers with a job id, not the
+                # instance; wait for the job, then fetch the real
+                # record for the result.
+                if not _wait_for_transition(module, api_client,
+                                            response, name, None,
+                                            timeout):
+                    module.fail_json(msg=f"Timed out waiting for instance {name} to be created")
+                result['instance'] = get_instance(module, api_client,
+                                                  name)
+            result['changed'] = True
+        elif _instance_matches(instance,
+                               _map_config(module,
+                                           module.params['config']),
+                               module.params['devices']):
+            # It exists and already looks the way we were asked for:
+            # done, without any further API calls.
+            result['changed'] = False
+        else:
+            # XXX - It exists, but its configuration differs. We
+            # don't support updating an existing instance yet; say
+            # so rather than silently claiming all is well.
+            result['msg'] = f"Instance {name} exists, but its configuration differs. Updating is not supported yet."
+            result['changed'] = False
+
+    elif state == 'started':
+        # Instance is supposed to exist and be running.
+        if instance is None:
+            if module.check_mode:
+                result['msg'] = f"Would have created and started instance {name}"
+            else:
+                response = create_instance(module, api_client)
+                # Wait for the create job before touching the
+                # instance: starting an instance whose create job
+                # hasn't finished yet just 404s.
+                if not _wait_for_transition(module, api_client,
+                                            response, name, None,
+                                            timeout):
+                    module.fail_json(msg=f"Timed out waiting for instance {name} to be created")
+                config = module.params['config'] or {}
+                if config.get('boot.autostart') in _TRUE_VALUES:
+                    # autostart was folded into the create payload,
+                    # so middlewared starts the instance itself; an
+                    # extra start call here would be the round-trip
+                    # the payload fold exists to save.
+                    started = wait_for_state(module, api_client,
+                                             name, 'Running', timeout)
+                else:
+                    response = start_instance(module, api_client,
+                                              name)
+                    started = _wait_for_transition(module, api_client,
+                                                   response, name,
+                                                   'Running', timeout)
+                if not started:
+                    module.fail_json(msg=f"Timed out waiting for instance {name} to start")
+                result['instance'] = get_instance(module, api_client,
+                                                  name)
+            result['changed'] = True
+        elif instance.get('status') != 'Running':
+            if module.check_mode:
+                result['msg'] = f"Would have started instance {name}"
+            else:
+                response = start_instance(module, api_client,
+                                          instance['id'])
+                if not _wait_for_transition(module, api_client,
+                                            response, name, 'Running',
+                                            timeout):
+                    module.fail_json(msg=f"Timed out waiting for instance {name} to start")
+            result['changed'] = True
+
+    elif state == 'stopped':
+        # Instance is supposed to exist, and not be running.
+        if instance is None:
+            module.fail_json(msg=f"Instance {name} does not exist")
+        elif instance.get('status') == 'Running':
+            if module.check_mode:
+                result['msg'] = f"Would have stopped instance {name}"
+            else:
+                response = stop_instance(module, api_client,
+                                         instance['id'])
+                if not _wait_for_transition(module, api_client,
+                                            response, name, 'Stopped',
+                                            timeout):
+                    module.fail_json(msg=f"Timed out waiting for instance {name} to stop")
+            result['changed'] = True
+
+    elif state == 'restarted':
+        # Unconditionally restart the instance.
+        if instance is None:
+            module.fail_json(msg=f"Instance {name} does not exist")
+        else:
+            if module.check_mode:
+                result['msg'] = f"Would have restarted instance {name}"
+            else:
+                response = restart_instance(module, api_client,
+                                            instance['id'])
+                if not _wait_for_transition(module, api_client,
+                                            response, name, 'Running',
+                                            timeout):
+                    module.fail_json(msg=f"Timed out waiting for instance {name} to restart")
+            result['changed'] = True
+
+    module.exit_json(**result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# Shared pytest setup for the module unit tests.
+#
+# Lives here so the individual test files don't each have to fiddle
+# with sys.path or re-stub time handling.
+
+import os
+import sys
+
+import pytest
+
+# Make the modules (and their module_utils helpers) importable
+# directly, without going through Ansible's collection loader.
+# Resolved once, and guarded so a re-import of this file (xdist
+# workers, --looponfail reloads) doesn't stack duplicate entries onto
+# sys.path.
+_PLUGIN_PATHS = (
+    os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                 '../../../../plugins/modules')),
+    os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                 '../../../../plugins/module_utils')),
+)
+for _path in _PLUGIN_PATHS:
+    if _path not in sys.path:
+        sys.path.insert(0, _path)
+
+
+def pytest_sessionstart(session):
+    """One-time setup for the whole test session.
+
+    Import the module under test once, so collection of the test
+    files doesn't pay for it repeatedly.
+    """
+    import truenas_incus_instance  # noqa: F401
+
+
+class _SleepCounter:
+    """Stands in for time.sleep: does nothing except count calls."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *_):
+        self.count += 1
+
+
+@pytest.fixture(autouse=True)
+def sleep_counter():
+    """Swallow and count every time.sleep, for every test.
+
+    Autouse, so even a test that doesn't ask for it can never hit a
+    real sleep. Tests that care about the wait loop's behavior take
+    the fixture by name and assert on .count instead of inspecting
+    mock call records.
+    """
+    import truenas_incus_instance as tim
+
+    orig_sleep = tim.time.sleep
+    counter = _SleepCounter()
+    tim.time.sleep = counter
+    yield counter
+    tim.time.sleep = orig_sleep
+
+
+@pytest.fixture
+def fake_clock():
+    """Let a test drive time.time from a fixed list of readings.
+
+    Yields an installer: call it with the sequence of clock values
+    the code under test should see. The real clock comes back after
+    the test.
+    """
+    import truenas_incus_instance as tim
+
+    orig_time = tim.time.time
+
+    def install(readings):
+        tim.time.time = iter(readings).__next__
+
+    yield install
+    tim.time.time = orig_time
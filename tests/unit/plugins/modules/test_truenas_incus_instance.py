@@ -0,0 +1,263 @@
+# Unit tests for the truenas_incus_instance module.
+#
+# These run without a TrueNAS box: the api_client handed to each
+# function is a mock, and we check what calls the module would have
+# made.
+#
+# Run with:
+#   pytest tests/unit/plugins/modules/test_truenas_incus_instance.py
+
+import copy
+from types import MappingProxyType, SimpleNamespace
+from unittest.mock import Mock, call
+
+import pytest
+
+# conftest.py has already set up sys.path and stubbed time.sleep for
+# the whole session; just import the module under test once.
+import truenas_incus_instance as tim
+
+
+class AnsibleFailJson(Exception):
+    """Raised by the mocked fail_json, so tests can catch failures."""
+
+
+# The default module params, built once and frozen: nothing in the
+# current tests mutates params, so they can all share this one
+# mapping. A test that needs to change a value should replace it with
+# copy.deepcopy(dict(_DEFAULT_PARAMS)) first.
+_DEFAULT_PARAMS = MappingProxyType({
+    'name': 'test-container',
+    'state': 'present',
+    'type': 'CONTAINER',
+    'source': 'debian/bookworm',
+    'config': {
+        'boot.autostart': 'true',
+        'limits.cpu': '2',
+    },
+    'devices': {
+        'eth0': {
+            'type': 'nic',
+            'network': 'br0',
+        },
+    },
+    'timeout': 60,
+    'api_url': 'https://localhost/api/v2.0',
+    'api_key': 'test-key',
+})
+
+# A bare Mock, on purpose: spec=AnsibleModule makes mock walk the
+# whole AnsibleModule class with inspect on construction, and these
+# tests only touch params / check_mode / fail_json / exit_json.
+_MOCK_MODULE_TEMPLATE = Mock()
+_MOCK_MODULE_TEMPLATE.check_mode = False
+_MOCK_MODULE_TEMPLATE.fail_json.side_effect = AnsibleFailJson
+
+_API_CLIENT_TEMPLATE = Mock()
+
+# The handful of response shapes most tests share, built once at
+# module scope. They're immutable as used (nothing assigns to them),
+# so handing the same object to every test is safe.
+_OK = SimpleNamespace(status_code=200, json=lambda: None, text='')
+_CREATED = SimpleNamespace(status_code=201,
+                           json=lambda: {'id': '123',
+                                         'name': 'test-container'},
+                           text='')
+_NO_CONTENT = SimpleNamespace(status_code=204, json=lambda: None, text='')
+_CONFLICT = SimpleNamespace(status_code=409, json=lambda: None,
+                            text='already exists')
+_SERVER_ERROR = SimpleNamespace(status_code=500, json=lambda: None,
+                                text='Internal Server Error')
+# Poll responses for the wait_for_state tests.
+_STOPPED_POLL = SimpleNamespace(status_code=200,
+                                json=lambda: {'name': 'test-container',
+                                              'status': 'Stopped'},
+                                text='')
+_RUNNING_POLL = SimpleNamespace(status_code=200,
+                                json=lambda: {'name': 'test-container',
+                                              'status': 'Running'},
+                                text='')
+
+
+@pytest.fixture
+def mock_module():
+    """An AnsibleModule stand-in, with the default params."""
+    module = copy.copy(_MOCK_MODULE_TEMPLATE)
+    module.params = _DEFAULT_PARAMS
+    return module
+
+
+def _client(response=None, responses=None):
+    """Hand out an api_client mock, copied from the module template.
+
+    'response' is what every call() should return; pass 'responses'
+    instead for a sequence of answers. The copy is shallow, so 'call'
+    gets built fresh -- configured through the Mock constructor rather
+    than post-assignment -- and call history can't leak between tests.
+    """
+    client = copy.copy(_API_CLIENT_TEMPLATE)
+    if responses is not None:
+        client.call = Mock(side_effect=responses)
+    else:
+        client.call = Mock(return_value=response)
+    return client
+
+
+@pytest.mark.parametrize("status,json_ret,expected_id,expect_fail", [
+    (200, {'id': '123', 'name': 'test-container', 'status': 'Running'},
+     '123', False),
+    (404, None, None, False),
+    (500, None, None, True),
+], ids=['found', 'not-found', 'api-error'])
+def test_get_instance(mock_module, status, json_ret, expected_id,
+                      expect_fail):
+    mock_response = SimpleNamespace(status_code=status,
+                                    json=lambda: json_ret,
+                                    text='response text')
+    mock_api_client = _client(mock_response)
+
+    if expect_fail:
+        with pytest.raises(AnsibleFailJson):
+            tim.get_instance(mock_module, mock_api_client,
+                             'test-container')
+        return
+
+    instance = tim.get_instance(mock_module, mock_api_client,
+                                'test-container')
+
+    if expected_id is None:
+        assert instance is None
+    else:
+        assert instance['id'] == expected_id
+    mock_api_client.call.assert_called_once_with(
+        '/virt/instance/id/test-container', method='GET',
+        use_cache=True)
+
+
+def test_create_instance_success(mock_module):
+    mock_api_client = _client(_CREATED)
+
+    response = tim.create_instance(mock_module, mock_api_client)
+
+    # create_instance hands back the raw response (a job id, like the
+    # other write endpoints); the caller waits on it.
+    assert response is _CREATED
+    args, kwargs = mock_api_client.call.call_args
+    assert args[0] == '/virt/instance'
+    assert kwargs['method'] == 'POST'
+    payload = kwargs['data']
+    assert payload['name'] == 'test-container'
+    assert payload['instance_type'] == 'CONTAINER'
+    assert payload['image'] == 'debian/bookworm'
+    # boot.autostart should have been folded into the create payload,
+    # not left for a separate start call.
+    assert payload['autostart'] is True
+    # Config keys go to their real schema fields; 'environment' is
+    # env vars, not config, and must not get the dict dumped into it.
+    assert payload['cpu'] == '2'
+    assert 'environment' not in payload
+
+
+def test_create_instance_unsupported_config_key(mock_module):
+    mock_module.params = dict(_DEFAULT_PARAMS)
+    mock_module.params['config'] = {'raw.lxc': 'lxc.apparmor.profile=unconfined'}
+    mock_api_client = _client(_CREATED)
+
+    with pytest.raises(AnsibleFailJson):
+        tim.create_instance(mock_module, mock_api_client)
+
+
+def test_create_instance_error(mock_module):
+    mock_api_client = _client(_CONFLICT)
+
+    with pytest.raises(AnsibleFailJson):
+        tim.create_instance(mock_module, mock_api_client)
+
+
+# start/stop/restart share one shape: POST to the action endpoint,
+# fail on a bad status. Parametrize instead of three near-identical
+# test bodies (times two for the error case).
+@pytest.mark.parametrize("func,endpoint", [
+    (tim.start_instance, '/virt/instance/123/start'),
+    (tim.stop_instance, '/virt/instance/123/stop'),
+    (tim.restart_instance, '/virt/instance/123/restart'),
+], ids=['start', 'stop', 'restart'])
+@pytest.mark.parametrize("mock_response,expect_fail", [
+    (_OK, False),
+    (_SERVER_ERROR, True),
+], ids=['success', 'error'])
+def test_lifecycle_action(mock_module, func, endpoint, mock_response,
+                          expect_fail):
+    mock_api_client = _client(mock_response)
+
+    if expect_fail:
+        with pytest.raises(AnsibleFailJson):
+            func(mock_module, mock_api_client, '123')
+        return
+
+    response = func(mock_module, mock_api_client, '123')
+
+    assert response is mock_response
+    mock_api_client.call.assert_called_once_with(endpoint, method='POST')
+
+
+def test_delete_instance_running(mock_module):
+    # A running instance has to be stopped before the DELETE.
+    mock_api_client = _client(responses=[_OK, _NO_CONTENT])
+
+    tim.delete_instance(mock_module, mock_api_client,
+                        {'id': '123', 'name': 'test-container',
+                         'status': 'Running'})
+
+    # Exactly these two calls, in this order. Plain list equality,
+    # rather than assert_has_calls' subsequence scan.
+    assert mock_api_client.call.call_args_list == [
+        call('/virt/instance/123/stop', method='POST'),
+        call('/virt/instance/123', method='DELETE'),
+    ]
+
+
+def test_delete_instance_already_stopped(mock_module):
+    # No stop call when the instance isn't running.
+    mock_api_client = _client(_NO_CONTENT)
+
+    tim.delete_instance(mock_module, mock_api_client,
+                        {'id': '123', 'name': 'test-container',
+                         'status': 'Stopped'})
+
+    mock_api_client.call.assert_called_once_with(
+        '/virt/instance/123', method='DELETE')
+
+
+def test_wait_for_state_success(mock_module, sleep_counter):
+    # First poll sees the old state, second sees the new one.
+    mock_api_client = _client(responses=[_STOPPED_POLL, _RUNNING_POLL])
+
+    reached = tim.wait_for_state(mock_module, mock_api_client,
+                                 'test-container', 'Running', 60)
+
+    assert reached is True
+    assert mock_api_client.call.call_count == 2
+    # The poll loop must go around the GET cache, or every sub-second
+    # re-poll would just re-read the first snapshot.
+    mock_api_client.call.assert_called_with(
+        '/virt/instance/id/test-container', method='GET',
+        use_cache=False)
+    # One failed poll, one sleep, then success.
+    assert sleep_counter.count == 1
+
+
+def test_wait_for_state_timeout(mock_module, fake_clock, sleep_counter):
+    # The clock starts at 0, and jumps past the deadline after two
+    # polls.
+    fake_clock([0, 30, 65])
+
+    mock_api_client = _client(_STOPPED_POLL)
+
+    reached = tim.wait_for_state(mock_module, mock_api_client,
+                                 'test-container', 'Running', 60)
+
+    assert reached is False
+    # Only the first failed poll slept; the second was already past
+    # the deadline.
+    assert sleep_counter.count == 1